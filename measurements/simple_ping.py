@@ -13,12 +13,11 @@ Arguments:
     --targets: Comma-separated list of target IP addresses or hostnames (or path to a hitlist file)
     --output: Output file name (default: ping_results_<timestamp>.csv.gz)
     --packets: Number of ping packets to send (default: 3)
-    --wait: Time to wait for measurement completion in seconds (default: 300)
+    --wait: Maximum time to wait for measurement completion in seconds (default: 300)
 
 TODOs:
 * Support hitlist and probe-id files
 * print credit costs before (wait for y/n from user)
-* exit wait early when the requested measurements have all finished
 * write output to output/ directory
 * support IPv6
 
@@ -28,46 +27,87 @@ python simple_ping.py --probes ALL --target 8.8.8.8
 """
 
 import argparse
-import csv
-import gzip
+import io
+import logging
 import os
 import sys
 import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Iterable, Iterator, Optional
+
+import numpy as np
+import pandas as pd
 from dotenv import load_dotenv
 load_dotenv()
 
+try:
+    # ISA-L accelerated drop-in replacement for the gzip module
+    from isal import igzip as gzip
+except ImportError:
+    import gzip
+
 try:
     from ripe.atlas.cousteau import (
         Ping,
         AtlasSource,
         AtlasCreateRequest,
         AtlasResultsRequest,
+        Measurement,
         ProbeRequest
     )
+    from ripe.atlas.cousteau.exceptions import APIResponseError
 except ImportError:
     print("Error: ripe.atlas.cousteau is not installed.")
     print("Install it with: pip install ripe.atlas.cousteau")
     sys.exit(1)
 
+logger = logging.getLogger(__name__)
+
 # API limit defined by RIPE Atlas
 MAX_PROBES_PER_MEASUREMENT = 1000
 
+# Measurement status IDs after which no more results will arrive
+# (Stopped, Forced to stop, No suitable probes, Failed)
+FINISHED_STATUS_IDS = {4, 5, 6, 7}
+
+# Seconds between measurement status checks while waiting
+POLL_INTERVAL = 10
+
+# Number of concurrent measurement status requests
+STATUS_WORKERS = 16
+
+# Common initial TTLs, used to derive the hop count from a received TTL
+INITIAL_TTLS = np.array([64, 128, 255], dtype=np.int16)
+
+# Record layout of a parsed ping reply
+PING_DTYPE = np.dtype([('probe_id', np.int64), ('rtt', np.float64), ('ttl', np.float64)])
+
+# Columns of the output CSV
+OUTPUT_COLUMNS = ['probe_id', 'rtt', 'hop_count']
+
+# gzip level for output files; level 1 is several times faster than the default 9
+# at a small cost in file size
+GZIP_COMPRESSLEVEL = 1
+
+# Buffer size in front of the gzip compressor, so many small writes are compressed at once
+WRITE_BUFFER_SIZE = 1024 * 1024
+
 def load_api_key() -> str:
     """Load RIPE Atlas API key from environment variable."""
     api_key = os.getenv('RIPE_ATLAS_API_KEY')
     if not api_key:
-        print("Error: RIPE_ATLAS_API_KEY environment variable not set.")
-        print("Please set it with your RIPE Atlas API key.")
-        print("Get your key from: https://atlas.ripe.net/keys/")
+        logger.error(
+            "RIPE_ATLAS_API_KEY environment variable not set. Please set it with your "
+            "RIPE Atlas API key. Get your key from: https://atlas.ripe.net/keys/"
+        )
         sys.exit(1)
     return api_key
 
 
 def get_all_probe_ids() -> List[int]:
     """Retrieve all available probe IDs from RIPE Atlas."""
-    print("Fetching all available probes...")
+    logger.info("Fetching all available probes...")
     probe_ids = []
     
     # Get probes with status=1 (connected)
@@ -77,7 +117,7 @@ def get_all_probe_ids() -> List[int]:
     for probe in probes:
         probe_ids.append(probe["id"])
     
-    print(f"Found {len(probe_ids):,} connected probes")
+    logger.info(f"Found {len(probe_ids):,} connected probes")
     return probe_ids
 
 
@@ -97,7 +137,7 @@ def parse_probe_list(probe_arg: str) -> List[int]:
         try:
             return [int(p.strip()) for p in probe_arg.split(',')]
         except ValueError:
-            print(f"Error: Invalid probe ID format: {probe_arg}")
+            logger.error(f"Invalid probe ID format: {probe_arg}")
             sys.exit(1)
 
 
@@ -124,6 +164,7 @@ def create_ping_measurement(
     target: str,
     packets: int = 3,
     chunk_index: int = 1,
+    probe_value: Optional[str] = None,
 ) -> int:
     """
     Create a ping measurement for a chunk of probes.
@@ -134,11 +175,12 @@ def create_ping_measurement(
         target: Target IP or hostname
         packets: Number of ping packets
         chunk_index: Chunk index
+        probe_value: Comma-separated probe IDs, if already built (default: built from probes)
     
     Returns:
         Measurement ID
     """
-    print(f"Creating ping measurement to {target} with {len(probes):,} probes... (Chunk {chunk_index})")
+    logger.info(f"Creating ping measurement to {target} with {len(probes):,} probes... (Chunk {chunk_index})")
     
     # Define ping measurement
     ping = Ping(
@@ -151,7 +193,7 @@ def create_ping_measurement(
     # Use specific probe IDs
     source = AtlasSource(
         type="probes",
-        value=",".join(map(str, probes)),
+        value=probe_value if probe_value is not None else ",".join(map(str, probes)),
         requested=len(probes)
     )
     
@@ -167,19 +209,59 @@ def create_ping_measurement(
     
     if is_success:
         measurement_id = response['measurements'][0]
-        print(f"Measurement created with ID: {measurement_id}")
+        logger.info(f"Measurement created with ID: {measurement_id}")
         return measurement_id
     else:
-        print(f"Error creating measurement: {response}")
+        logger.error(f"Could not create measurement: {response}")
         sys.exit(1)
 
 
-def wait_for_measurement(measurement_id: int, wait_time: int = 300):
-    """Wait for measurement to complete."""
-    print(f"Waiting for measurement {measurement_id} to complete...")
-    print(f"This may take up to {wait_time} seconds...")
-    time.sleep(wait_time)
-    print("Wait complete. Fetching results...")
+def get_measurement_status(api_key: str, measurement_id: int) -> Optional[int]:
+    """
+    Get the status ID of a measurement.
+    
+    Args:
+        api_key: RIPE Atlas API key
+        measurement_id: Measurement ID
+    
+    Returns:
+        Status ID, or None if the status could not be retrieved
+    """
+    try:
+        return Measurement(id=measurement_id, key=api_key, fields=['status']).status_id
+    except APIResponseError as e:
+        logger.warning(f"Could not get status of measurement {measurement_id}: {e}")
+        return None
+
+
+def wait_for_measurements(api_key: str, measurement_ids: List[int], wait_time: int = 300):
+    """
+    Wait until all measurements have finished, or until wait_time seconds have passed.
+    
+    Args:
+        api_key: RIPE Atlas API key
+        measurement_ids: List of measurement IDs
+        wait_time: Maximum time to wait in seconds
+    """
+    logger.info(f"Waiting for {len(measurement_ids):,} measurement(s) to complete...")
+    logger.info(f"This may take up to {wait_time} seconds...")
+    
+    deadline = time.monotonic() + wait_time
+    pending = list(measurement_ids)
+    
+    with ThreadPoolExecutor(max_workers=STATUS_WORKERS) as executor:
+        while True:
+            statuses = executor.map(lambda msm_id: get_measurement_status(api_key, msm_id), pending)
+            pending = [msm_id for msm_id, status in zip(pending, statuses) if status not in FINISHED_STATUS_IDS]
+            
+            remaining = deadline - time.monotonic()
+            if not pending or remaining <= 0:
+                break
+            time.sleep(min(POLL_INTERVAL, remaining))
+    
+    if pending:
+        logger.warning(f"Timed out with {len(pending):,} measurement(s) still running")
+    logger.info("Wait complete. Fetching results...")
 
 
 def fetch_measurement_results(measurement_id: int) -> List[Dict[str, Any]]:
@@ -192,7 +274,7 @@ def fetch_measurement_results(measurement_id: int) -> List[Dict[str, Any]]:
     Returns:
         List of result dictionaries
     """
-    print(f"Fetching results for measurement {measurement_id}...")
+    logger.info(f"Fetching results for measurement {measurement_id}...")
     
     kwargs = {
         "msm_id": measurement_id
@@ -201,14 +283,30 @@ def fetch_measurement_results(measurement_id: int) -> List[Dict[str, Any]]:
     is_success, results = AtlasResultsRequest(**kwargs).create()
     
     if is_success:
-        print(f"Retrieved {len(results):,} results")
+        logger.info(f"Retrieved {len(results):,} results")
         return results
     else:
-        print(f"Error fetching results: {results}")
+        logger.error(f"Could not fetch results: {results}")
         return []
 
 
-def parse_ping_results(results: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+def compute_hop_counts(ttl: np.ndarray) -> np.ndarray:
+    """
+    Calculate hop counts from received TTLs.
+    
+    hop_count = initial_ttl - ttl, with initial_ttl the smallest of INITIAL_TTLS >= ttl.
+    
+    Args:
+        ttl: int16 array of received TTLs
+    
+    Returns:
+        int16 array of hop counts
+    """
+    # Look up the initial TTL with searchsorted instead of a chain of comparisons
+    return INITIAL_TTLS[np.searchsorted(INITIAL_TTLS, ttl)] - ttl
+
+
+def parse_ping_results(results: List[Dict[str, Any]]) -> pd.DataFrame:
     """
     Parse ping results and extract relevant data.
     
@@ -216,71 +314,81 @@ def parse_ping_results(results: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
         results: List of raw measurement results
     
     Returns:
-        List of parsed results with probe_id, rtt, and hop_count
+        DataFrame with probe_id, rtt, and hop_count columns (one row per ping reply)
     """
-    parsed_results = []
-    
-    for result in results:
-        probe_id = result.get('prb_id')
-        
-        # Check if result contains ping data
-        if 'result' not in result:
-            continue
-        
-        ping_results = result.get('result', [])
-        
-        for ping in ping_results:
-            # Skip if no RTT (ping failed)
-            if 'rtt' not in ping:
-                continue
-            
-            rtt = ping.get('rtt')
-            
-            # Calculate hop_count from TTL
-            # hop_count = initial_ttl - ttl
-            # Common initial TTLs are 64, 128, 255
-            ttl = ping.get('ttl')
-            hop_count = None
-            
-            if ttl is not None:
-                # Determine likely initial TTL
-                if ttl <= 64:
-                    initial_ttl = 64
-                elif ttl <= 128:
-                    initial_ttl = 128
-                else:
-                    initial_ttl = 255
-                
-                hop_count = initial_ttl - ttl
-            
-            parsed_results.append({
-                'probe_id': probe_id,
-                'rtt': rtt,
-                'hop_count': hop_count if hop_count is not None else 0
-            })
+    # Stream one (probe_id, rtt, ttl) record per ping straight from the raw results into
+    # a typed array, skipping pings without RTT (ping failed)
+    pings = np.fromiter(
+        (
+            (result['prb_id'], ping['rtt'], ping.get('ttl', np.nan))
+            for result in results
+            for ping in result.get('result', [])
+            if 'rtt' in ping
+        ),
+        dtype=PING_DTYPE,
+    )
     
-    return parsed_results
+    # Calculate hop_count from TTL
+    # Pings without TTL are set to an initial TTL so their hop_count becomes 0
+    ttl = np.nan_to_num(pings['ttl'], nan=INITIAL_TTLS[0]).astype(np.int16)
+    hop_count = compute_hop_counts(ttl)
+    
+    return pd.DataFrame({'probe_id': pings['probe_id'], 'rtt': pings['rtt'], 'hop_count': hop_count})
 
 
-def write_results_to_csv(results: List[Dict[str, Any]], output_file: str):
+def open_gzip_csv(output_file: str) -> io.TextIOWrapper:
+    """
+    Open a gzip-compressed CSV file for writing through a large write buffer.
+    
+    Args:
+        output_file: Output file path
+    
+    Returns:
+        Text stream; closing it flushes and closes the underlying gzip file
+    """
+    raw = gzip.GzipFile(output_file, 'wb', compresslevel=GZIP_COMPRESSLEVEL)
+    buffered = io.BufferedWriter(raw, buffer_size=WRITE_BUFFER_SIZE)
+    return io.TextIOWrapper(buffered, encoding='utf-8', newline='')
+
+
+def iter_ping_results(measurement_ids: List[int]) -> Iterator[pd.DataFrame]:
+    """
+    Fetch and parse results one measurement at a time.
+    
+    Only a single measurement's results are held in memory at any time.
+    
+    Args:
+        measurement_ids: List of measurement IDs
+    
+    Yields:
+        DataFrame of parsed results for each measurement
+    """
+    for measurement_id in measurement_ids:
+        # Parse directly from the fetch so the raw results are freed before the rows are written
+        yield parse_ping_results(fetch_measurement_results(measurement_id))
+
+
+def write_results_to_csv(results: Iterable[pd.DataFrame], output_file: str) -> int:
     """
     Write results to compressed CSV file.
     
     Args:
-        results: List of parsed results
+        results: Iterable of DataFrames of parsed results, written as they arrive
         output_file: Output file path
+    
+    Returns:
+        Number of rows written
     """
-    print(f"Writing {len(results):,} results to {output_file}...")
+    logger.info(f"Writing results to {output_file}...")
     
-    with gzip.open(output_file, 'wt', newline='') as csvfile:
-        fieldnames = ['probe_id', 'rtt', 'hop_count']
-        writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
-        
-        writer.writeheader()
-        for row in results:
-            writer.writerow(row)
+    total = 0
+    with open_gzip_csv(output_file) as csvfile:
+        for i, df in enumerate(results):
+            df.to_csv(csvfile, index=False, columns=OUTPUT_COLUMNS, header=(i == 0))
+            total += len(df)
     
-    print(f"Results written to {output_file}")
+    logger.info(f"{total:,} results written to {output_file}")
+    return total
 
 
 def main():
@@ -318,11 +426,13 @@ def main():
         '--wait',
         type=int,
         default=300,
-        help='Time to wait for measurement completion in seconds (default: 300)'
+        help='Maximum time to wait for measurement completion in seconds (default: 300)'
     )
     
     args = parser.parse_args()
     
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s: %(message)s')
+    
     # Load API key
     api_key = load_api_key()
     
@@ -330,44 +440,42 @@ def main():
     probes = parse_probe_list(args.probes)
     targets = parse_target_list(args.targets)
     
-    print(f"Using {len(probes):,} probes")
-    print(f"Targeting {len(targets):,} destination(s): {', '.join(targets)}")
+    logger.info(f"Using {len(probes):,} probes")
+    logger.info(f"Targeting {len(targets):,} destination(s): {', '.join(targets)}")
     
     # Set default output file if not provided
     if not args.output:
         timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
         args.output = f"ping_results_{timestamp}.csv.gz"
     
-    # Collect all results
-    all_results = []
-    
     # Create measurements for each target
     measurement_ids = []
 
+    # Split probes into chunks of 1k, building each chunk's probe list string once for all targets
+    probe_chunks = [
+        (probe_chunk, ",".join(map(str, probe_chunk)))
+        for probe_chunk in chunk_list(probes, MAX_PROBES_PER_MEASUREMENT)
+    ]
+    
     for target in targets:
-        print(f"Targeting: {target}")
-        # Split probes into chunks of 1k
-        for idx, probe_chunk in enumerate(chunk_list(probes, MAX_PROBES_PER_MEASUREMENT), 1):
-            msm_id = create_ping_measurement(api_key, probe_chunk, target, args.packets, idx)
+        logger.info(f"Targeting: {target}")
+        for idx, (probe_chunk, probe_value) in enumerate(probe_chunks, 1):
+            msm_id = create_ping_measurement(api_key, probe_chunk, target, args.packets, idx, probe_value)
             measurement_ids.append(msm_id)
             # Short sleep to avoid hitting API rate limits or overwhelming target
             time.sleep(1)
     
     # Wait for measurements to complete
-    wait_for_measurement(measurement_ids[0], args.wait)
+    wait_for_measurements(api_key, measurement_ids, args.wait)
     
-    # Fetch and parse results
-    for measurement_id in measurement_ids:
-        results = fetch_measurement_results(measurement_id)
-        parsed = parse_ping_results(results)
-        all_results.extend(parsed)
-    
-    # Write results to CSV
-    if all_results:
-        write_results_to_csv(all_results, args.output)
-        print(f"\nSuccess! Total results: {len(all_results):,}")
+    # Fetch, parse and write results one measurement at a time
+    total = write_results_to_csv(iter_ping_results(measurement_ids), args.output)
+    
+    if total:
+        logger.info(f"Success! Total results: {total:,}")
     else:
-        print("Warning: No results were collected")
+        logger.warning("No results were collected")
+        os.remove(args.output)
         sys.exit(1)
 
 
@@ -21,14 +21,52 @@ Public Functions:
 """
 
 import argparse
+import asyncio
+import functools
+import io
 import json
+import logging
+import multiprocessing
 import os
+import random
+import shutil
+import sqlite3
 import sys
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import closing
 from pathlib import Path
 
+import httpx
+import numpy as np
 import pandas as pd
-import requests
 
+try:
+    # ISA-L accelerated drop-in replacement for the gzip module
+    from isal import igzip as gzip
+except ImportError:
+    import gzip
+
+try:
+    # Parallel gzip decompression for reading large input files
+    import rapidgzip
+except ImportError:
+    rapidgzip = None
+
+try:
+    # Progress bar for fetching probe metadata
+    from tqdm import tqdm
+except ImportError:
+    tqdm = None
+
+try:
+    # Faster JSON decoding of API responses; orjson.JSONDecodeError subclasses json.JSONDecodeError
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
+
+logger = logging.getLogger(__name__)
 
 # Default metadata structure for probes with missing/unavailable data
 DEFAULT_METADATA = {
@@ -41,52 +79,506 @@ DEFAULT_METADATA = {
     'asn': None,
 }
 
-# TODO slow for a large list of probes, faster to fetch all probe_ids at once and inner join later
+# Compact dtypes for the metadata columns: values repeat for every row of a probe, so
+# strings are stored as categoricals. ASNs are 32-bit unsigned, so UInt32 rather than Int32
+METADATA_DTYPES = {
+    'country': 'category',
+    'city': 'category',
+    'lat': 'float32',
+    'lon': 'float32',
+    'ipv4': 'category',
+    'ipv6': 'category',
+    'asn': 'UInt32',
+}
+
+# Maximum number of concurrent connections to the RIPE Atlas API
+MAX_CONNECTIONS = 64
+
+# Maximum number of requests in flight at once. HTTP/2 multiplexes requests over
+# few connections, so the connection limit alone does not bound concurrency
+MAX_CONCURRENT_REQUESTS = 64
+
+# Maximum sustained request rate (requests per second) to the RIPE Atlas API
+MAX_REQUESTS_PER_SECOND = 20
+
+# Retry policy for transient API errors: exponential backoff with jitter, capped
+MAX_RETRIES = 5
+MAX_RETRY_DELAY = 60
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+# Maximum number of probes returned per page by the RIPE Atlas probes API
+PROBES_PAGE_SIZE = 500
+
+PROBES_API_URL = "https://atlas.ripe.net/api/v2/probes/"
+
+# Probe fields requested from the API; everything else is left out of the responses
+PROBE_FIELDS = 'id,country_code,city,geometry,address_v4,address_v6,asn_v4'
+
+# Supported formats of the enriched output file
+OUTPUT_FORMATS = ('csv.gz', 'parquet')
+
+# Compression level of gzipped CSV output (1 = fastest)
+GZIP_COMPRESSLEVEL = 1
+
+# Number of input rows read, enriched and written at a time
+CHUNK_SIZE = 500_000
+
+# Size of the write buffer in front of the gzip compressor
+WRITE_BUFFER_SIZE = 1024 * 1024
+
+# Default number of processes enriching csv.gz output; each holds a chunk in memory
+DEFAULT_WORKERS = 4
+
+# Local cache of probe metadata, reused across runs
+CACHE_PATH = Path("~/.ripe_atlas_probe_cache.sqlite").expanduser()
+
+# Cached metadata older than this (in seconds) is fetched again
+CACHE_TTL = 7 * 24 * 60 * 60
+
+# Number of single-probe lookups memoized in memory by fetch_probe_metadata
+PROBE_MEMO_SIZE = 100_000
+
+
+def _run(coro):
+    """
+    Run a coroutine to completion from synchronous code.
+    
+    asyncio.run() cannot be used when an event loop is already running
+    (e.g. inside a Jupyter notebook), so in that case the coroutine is run
+    on its own event loop in a worker thread.
+    """
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(coro)
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        return executor.submit(asyncio.run, coro).result()
+
+
+def _extract_metadata(data):
+    """
+    Extract the metadata fields from a RIPE Atlas probe object.
+    
+    Args:
+        data: Probe object as returned by the RIPE Atlas API
+        
+    Returns:
+        dict: Probe metadata with keys: country, city, lat, lon, ipv4, ipv6, asn
+    """
+    # Extract coordinates once to avoid repeated lookups
+    geometry = data.get('geometry')
+    coordinates = geometry.get('coordinates', [None, None]) if geometry else [None, None]
+    
+    return {
+        'country': data.get('country_code'),
+        'city': data.get('city'),
+        'lat': coordinates[1],
+        'lon': coordinates[0],
+        'ipv4': data.get('address_v4'),
+        'ipv6': data.get('address_v6'),
+        'asn': data.get('asn_v4'),
+    }
+
+
+# HTTP/2 client reused by single-probe lookups, created on first use
+_client = None
+
+
+def _get_client():
+    """Return the shared client for single-probe lookups, so that connections are kept alive between calls."""
+    global _client
+    if _client is None:
+        limits = httpx.Limits(max_connections=MAX_CONNECTIONS, max_keepalive_connections=MAX_CONNECTIONS)
+        _client = httpx.Client(http2=True, limits=limits, timeout=10)
+    return _client
+
+
+@functools.lru_cache(maxsize=PROBE_MEMO_SIZE)
+def _fetch_probe_metadata(probe_id):
+    """Fetch a single probe's metadata, raising on failure so that failures are not memoized."""
+    response = _get_client().get(f"{PROBES_API_URL}{probe_id}/", params={'fields': PROBE_FIELDS})
+    if response.status_code != 200:
+        raise LookupError(f"HTTP {response.status_code}")
+    return _extract_metadata(json_loads(response.content))
+
+
 def fetch_probe_metadata(probe_id):
     """
     Fetch metadata for a single probe from RIPE Atlas API.
     
+    Successful lookups are memoized in memory, so repeated calls for the same
+    probe do not hit the API again.
+    
     Args:
         probe_id: The probe ID to fetch metadata for
         
     Returns:
         dict: Probe metadata with keys: country, city, lat, lon, ipv4, ipv6, asn
     """
-    url = f"https://atlas.ripe.net/api/v2/probes/{probe_id}/"
+    try:
+        # Copy so that callers modifying the result do not alter the memoized entry
+        return _fetch_probe_metadata(probe_id).copy()
+    except (httpx.RequestError, json.JSONDecodeError, LookupError) as e:
+        logger.warning(f"Could not fetch metadata for probe {probe_id}: {e}")
+        return DEFAULT_METADATA.copy()
+
+
+class _RateLimiter:
+    """
+    Token bucket limiting the request rate of all tasks on one event loop.
+    
+    The bucket can also be paused, e.g. when the API reports that the rate
+    limit has been reached, so that all tasks back off together.
+    """
+    
+    def __init__(self, rate):
+        self.rate = rate
+        self.tokens = rate
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self.lock = asyncio.Lock()
+    
+    async def acquire(self):
+        """Wait until a request may be sent."""
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                if now < self.paused_until:
+                    await asyncio.sleep(self.paused_until - now)
+                    continue
+                self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+    
+    def pause(self, delay):
+        """Stop handing out tokens for delay seconds."""
+        self.paused_until = max(self.paused_until, time.monotonic() + delay)
     
+    def update(self, headers):
+        """Pause until the rate limit window resets if the API reports it exhausted."""
+        remaining = _parse_number(headers.get('X-RateLimit-Remaining'))
+        reset = _parse_number(headers.get('X-RateLimit-Reset'))
+        if remaining is not None and remaining <= 0 and reset is not None:
+            # The reset is either an absolute epoch timestamp or a number of seconds
+            delay = reset - time.time() if reset > 1e9 else reset
+            self.pause(min(max(delay, 0), MAX_RETRY_DELAY))
+
+
+def _parse_number(value):
+    """Parse a numeric header value, returning None if absent or malformed."""
     try:
-        response = requests.get(url, timeout=10)
-        response.raise_for_status()
-        data = response.json()
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _retry_delay(response, attempt):
+    """Delay before retrying a failed request: Retry-After if given, else exponential backoff with jitter."""
+    retry_after = _parse_number(response.headers.get('Retry-After'))
+    if retry_after is None:
+        retry_after = 2 ** attempt + random.random()
+    return min(retry_after, MAX_RETRY_DELAY)
+
+
+async def _get_with_retries(client, semaphore, limiter, url, params=None):
+    """
+    GET a URL within the rate limit, retrying with backoff on transient HTTP status codes.
+    
+    The last response is returned whatever its status code; callers check it.
+    """
+    for attempt in range(MAX_RETRIES + 1):
+        await limiter.acquire()
+        # Only hold a request slot while the request is in flight, not while backing off
+        async with semaphore:
+            response = await client.get(url, params=params)
+        limiter.update(response.headers)
         
-        # Extract coordinates once to avoid repeated lookups
-        geometry = data.get('geometry')
-        coordinates = geometry.get('coordinates', [None, None]) if geometry else [None, None]
+        if response.status_code not in RETRY_STATUSES or attempt == MAX_RETRIES:
+            break
+        delay = _retry_delay(response, attempt)
+        if response.status_code == 429:
+            # Rate limited: hold back all requests, not just this one
+            limiter.pause(delay)
+        await asyncio.sleep(delay)
+    
+    return response
+
+
+async def _fetch_probe_batch(client, semaphore, limiter, probe_ids):
+    """
+    Fetch metadata for a batch of probes with a single (paginated) API listing.
+    
+    Args:
+        client: httpx.AsyncClient to use
+        semaphore: asyncio.Semaphore bounding the number of requests in flight
+        limiter: _RateLimiter bounding the request rate
+        probe_ids: List of at most PROBES_PAGE_SIZE probe IDs
         
-        # Extract metadata from the response
-        metadata = {
-            'country': data.get('country_code'),
-            'city': data.get('city'),
-            'lat': coordinates[1],
-            'lon': coordinates[0],
-            'ipv4': data.get('address_v4'),
-            'ipv6': data.get('address_v6'),
-            'asn': data.get('asn_v4'),
-        }
+    Returns:
+        dict: Mapping of probe ID to metadata for every probe returned by the API
+    """
+    metadata = {}
+    url = PROBES_API_URL
+    params = {'id__in': ','.join(map(str, probe_ids)), 'page_size': PROBES_PAGE_SIZE, 'fields': PROBE_FIELDS}
+    
+    try:
+        while url:
+            response = await _get_with_retries(client, semaphore, limiter, url, params)
+            if response.status_code != 200:
+                logger.warning(f"Could not fetch metadata for {len(probe_ids)} probes "
+                               f"({probe_ids[0]}..{probe_ids[-1]}): HTTP {response.status_code}")
+                break
+            data = json_loads(response.content)
+            for probe in data.get('results', []):
+                metadata[probe['id']] = _extract_metadata(probe)
+            # The 'next' link already carries the query parameters
+            url = data.get('next')
+            params = None
+    except (httpx.RequestError, json.JSONDecodeError) as e:
+        logger.warning(f"Could not fetch metadata for {len(probe_ids)} probes "
+                       f"({probe_ids[0]}..{probe_ids[-1]}): {e}")
+    
+    return metadata
+
+
+async def _fetch_all_batches(batches, verbose=False):
+    """Fetch all batches concurrently over a single HTTP/2 client."""
+    limits = httpx.Limits(max_connections=MAX_CONNECTIONS, max_keepalive_connections=MAX_CONNECTIONS)
+    transport = httpx.AsyncHTTPTransport(http2=True, limits=limits, retries=MAX_RETRIES)
+    
+    semaphore = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+    limiter = _RateLimiter(MAX_REQUESTS_PER_SECOND)
+    
+    metadata = {}
+    async with httpx.AsyncClient(transport=transport, timeout=30) as client:
+        tasks = [_fetch_probe_batch(client, semaphore, limiter, batch) for batch in batches]
+        # tqdm writes to stderr and repaints at a throttled rate; without it, every batch is logged
+        progress = None
+        if verbose and tqdm is not None:
+            progress = tqdm(total=len(batches), desc="Fetching probe metadata", unit="batch")
+        try:
+            for i, task in enumerate(asyncio.as_completed(tasks), 1):
+                metadata.update(await task)
+                if progress is not None:
+                    progress.update()
+                elif verbose:
+                    logger.info(f"Progress: {i:,}/{len(batches):,} batches")
+        finally:
+            if progress is not None:
+                progress.close()
+    
+    return metadata
+
+
+def fetch_probe_metadata_bulk(probe_ids, verbose=False):
+    """
+    Fetch metadata for many probes using the RIPE Atlas bulk probe listing.
+    
+    Probe IDs are sorted and split into batches of PROBES_PAGE_SIZE, which are
+    fetched concurrently on a single event loop over a shared HTTP/2 connection pool.
+    
+    Args:
+        probe_ids: Iterable of probe IDs (ints)
+        verbose: If True, log progress messages at INFO level (default: False)
         
-        return metadata
+    Returns:
+        dict: Mapping of probe ID to metadata. Probes that could not be fetched are omitted.
+    """
+    # Sorted, so that each batch covers a contiguous ID range
+    probe_ids = np.sort(np.fromiter(probe_ids, dtype=np.int64)).tolist()
+    batches = [probe_ids[i:i + PROBES_PAGE_SIZE] for i in range(0, len(probe_ids), PROBES_PAGE_SIZE)]
+    return _run(_fetch_all_batches(batches, verbose))
+
+
+def _open_cache(cache_path):
+    """Open the probe metadata cache, creating the table if needed."""
+    conn = sqlite3.connect(cache_path)
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS probe_metadata ("
+        "probe_id INTEGER PRIMARY KEY, fetched_at INTEGER, "
+        "country TEXT, city TEXT, lat REAL, lon REAL, ipv4 TEXT, ipv6 TEXT, asn INTEGER)"
+    )
+    return conn
+
+
+def load_cached_metadata(probe_ids, cache_path=CACHE_PATH, ttl=CACHE_TTL):
+    """
+    Load probe metadata from the local cache.
+    
+    Args:
+        probe_ids: Iterable of probe IDs (ints) to look up
+        cache_path: Path to the SQLite cache file (default: CACHE_PATH)
+        ttl: Maximum age of cached entries in seconds (default: CACHE_TTL)
         
-    except (requests.RequestException, json.JSONDecodeError, KeyError) as e:
-        print(f"Warning: Could not fetch metadata for probe {probe_id}: {e}", file=sys.stderr)
-        return DEFAULT_METADATA.copy()
+    Returns:
+        dict: Mapping of probe ID to metadata for probes with a fresh cache entry
+    """
+    if not Path(cache_path).exists():
+        return {}
+    
+    probe_ids = set(probe_ids)
+    columns = list(DEFAULT_METADATA)
+    try:
+        with closing(_open_cache(cache_path)) as conn:
+            rows = conn.execute(
+                f"SELECT probe_id, {', '.join(columns)} FROM probe_metadata WHERE fetched_at >= ?",
+                (int(time.time() - ttl),),
+            ).fetchall()
+    except sqlite3.Error as e:
+        logger.warning(f"Could not read probe cache {cache_path}: {e}")
+        return {}
+    
+    return {row[0]: dict(zip(columns, row[1:])) for row in rows if row[0] in probe_ids}
 
 
-def enrich_dataframe_with_probe_metadata(df, verbose=True):
+def store_cached_metadata(probe_metadata, cache_path=CACHE_PATH):
+    """
+    Store probe metadata in the local cache, replacing existing entries.
+    
+    Args:
+        probe_metadata: Mapping of probe ID to metadata
+        cache_path: Path to the SQLite cache file (default: CACHE_PATH)
+    """
+    columns = list(DEFAULT_METADATA)
+    fetched_at = int(time.time())
+    rows = [
+        (probe_id, fetched_at, *(metadata[col] for col in columns))
+        for probe_id, metadata in probe_metadata.items()
+    ]
+    try:
+        with closing(_open_cache(cache_path)) as conn, conn:
+            conn.executemany(
+                f"INSERT OR REPLACE INTO probe_metadata (probe_id, fetched_at, {', '.join(columns)}) "
+                f"VALUES ({', '.join('?' * (len(columns) + 2))})",
+                rows,
+            )
+    except sqlite3.Error as e:
+        logger.warning(f"Could not write probe cache {cache_path}: {e}")
+
+
+def _unique_probe_ids(probe_ids):
+    """Return the unique, non-missing values of a probe ID Series as a set of ints."""
+    # Raises ValueError for values that are not valid probe IDs
+    return set(probe_ids.dropna().astype(np.int64).unique().tolist())
+
+
+def _string_categorical(values):
+    """
+    Convert text values to a categorical whose categories are always strings.
+    
+    Inferring the categories would give them a float dtype when all values are
+    missing, so that e.g. an ipv6 column without addresses would change type
+    between runs.
+    
+    Args:
+        values: Iterable of strings and missing values
+        
+    Returns:
+        pandas Series: Categorical with 'string' categories
+    """
+    values = pd.Series(values, dtype='string')
+    categories = pd.Index(values.dropna().unique(), dtype='string')
+    return values.astype(pd.CategoricalDtype(categories))
+
+
+def _probe_metadata_frame(probe_ids, verbose=False, use_cache=True):
+    """
+    Build a metadata table for the given probes from the local cache and the API.
+    
+    Args:
+        probe_ids: Set of probe IDs (ints)
+        verbose: If True, log progress messages at INFO level (default: False)
+        use_cache: If True, use the local probe metadata cache (default: True)
+        
+    Returns:
+        pandas DataFrame: One row per probe found, with a 'probe_id' column and the metadata columns
+    """
+    # Use cached metadata where available and fetch the remaining probes in bulk
+    fetched = load_cached_metadata(probe_ids) if use_cache else {}
+    missing_ids = probe_ids - fetched.keys()
+    if verbose:
+        logger.info(f"Found {len(fetched):,} of {len(probe_ids):,} unique probes in cache")
+        logger.info(f"Fetching metadata for {len(missing_ids):,} probes...")
+    
+    if missing_ids:
+        new_metadata = fetch_probe_metadata_bulk(missing_ids, verbose=verbose)
+        if use_cache:
+            store_cached_metadata(new_metadata)
+        fetched.update(new_metadata)
+    
+    # Build each column directly as a typed array rather than converting per-probe rows,
+    # in probe ID order regardless of whether a probe came from the cache or the API
+    probe_order = np.sort(np.fromiter(fetched, dtype=np.int64, count=len(fetched)))
+    metadata = [fetched[probe_id] for probe_id in probe_order.tolist()]
+    columns = {'probe_id': probe_order}
+    for col, dtype in METADATA_DTYPES.items():
+        values = [m[col] for m in metadata]
+        columns[col] = _string_categorical(values) if dtype == 'category' else pd.Series(values, dtype=dtype)
+    return pd.DataFrame(columns)
+
+
+def _missing_metadata(df):
+    """
+    Return a boolean mask of the rows that still need probe metadata.
+    
+    A row counts as enriched once it has a 'country'; other fields such as
+    city or ipv6 are legitimately empty for many probes. Rows without a
+    probe ID cannot be looked up and never count as missing.
+    """
+    if 'country' not in df.columns:
+        return df['probe_id'].notna()
+    return df['country'].isna() & df['probe_id'].notna()
+
+
+def _merge_probe_metadata(df, meta_df, only_missing=False):
+    """
+    Join the metadata onto the rows with a single vectorized left merge.
+    
+    Metadata columns already present in df are replaced in place, and rows for probes
+    without metadata get NaN. The merge returns a new frame, so df is left
+    untouched without copying it first.
+    
+    Args:
+        df: pandas DataFrame with a 'probe_id' column
+        meta_df: Metadata table as returned by _probe_metadata_frame
+        only_missing: If True, rows that already have metadata keep their existing
+            values (default: False)
+        
+    Returns:
+        pandas DataFrame: df with the metadata columns, keeping df's index
+    """
+    # The key is cast to the column's dtype so the merge keys match
+    meta_df = meta_df.astype({'probe_id': df['probe_id'].dtype})
+    existing_cols = [col for col in DEFAULT_METADATA if col in df.columns]
+    result_df = df.drop(columns=existing_cols) if existing_cols else df
+    result_df = result_df.merge(meta_df, on='probe_id', how='left')
+    result_df.index = df.index
+    if existing_cols:
+        # Put replaced metadata columns back where they were in the input
+        new_cols = [col for col in DEFAULT_METADATA if col not in df.columns]
+        result_df = result_df[[*df.columns, *new_cols]]
+    
+    if only_missing and existing_cols:
+        keep = ~_missing_metadata(df)
+        for col in existing_cols:
+            values = df[col].where(keep, result_df[col].astype(object))
+            if METADATA_DTYPES[col] == 'category':
+                # Same string categories as freshly fetched columns, also when a chunk has no values
+                result_df[col] = _string_categorical(values)
+            else:
+                result_df[col] = values.astype(METADATA_DTYPES[col])
+    return result_df
+
+
+def enrich_dataframe_with_probe_metadata(df, verbose=True, use_cache=True, only_missing=False):
     """
     Add probe metadata columns to a pandas DataFrame containing a 'probe_id' column.
     
     This function enriches a DataFrame with probe metadata fetched from the RIPE Atlas API.
-    For each unique probe_id, it fetches and adds the following columns:
+    For each unique probe_id, it fetches (or reads from the local cache) and adds the following columns:
     - country: Country code
     - city: City name
     - lat: Latitude
@@ -97,13 +589,18 @@ def enrich_dataframe_with_probe_metadata(df, verbose=True):
     
     Args:
         df: pandas DataFrame with a 'probe_id' column
-        verbose: If True, print progress messages (default: True)
+        verbose: If True, log progress messages at INFO level (default: True)
+        use_cache: If True, reuse metadata cached by previous runs and cache newly fetched
+            metadata (default: True)
+        only_missing: If True, only look up probes for rows without a 'country' value and
+            keep the existing metadata of all other rows (default: False)
         
     Returns:
-        pandas DataFrame: A copy of the input DataFrame with added metadata columns
+        pandas DataFrame: A new DataFrame with the input's columns and added metadata columns
         
     Raises:
-        ValueError: If the DataFrame does not contain a 'probe_id' column
+        ValueError: If the DataFrame does not contain a 'probe_id' column, or if it
+            contains values that are not valid probe IDs
         
     Example:
         >>> import pandas as pd
@@ -116,53 +613,200 @@ def enrich_dataframe_with_probe_metadata(df, verbose=True):
     if 'probe_id' not in df.columns:
         raise ValueError("DataFrame must contain a 'probe_id' column")
     
-    # Create a copy to avoid modifying the original dataframe
-    result_df = df.copy()
-    
     if verbose:
-        print(f"Found {len(result_df)} rows with probe IDs")
+        logger.info(f"Found {len(df)} rows with probe IDs")
     
-    # Get unique probe IDs to avoid duplicate API calls
-    unique_probe_ids = result_df['probe_id'].unique()
-    if verbose:
-        print(f"Fetching metadata for {len(unique_probe_ids)} unique probes...")
-    
-    # Fetch metadata for each unique probe
-    probe_metadata = {}
-    for i, probe_id in enumerate(unique_probe_ids, 1):
-        if pd.notna(probe_id):
-            if verbose and i % 10 == 0:
-                print(f"Progress: {i:,}/{len(unique_probe_ids):,} probes")
-            try:
-                probe_metadata[probe_id] = fetch_probe_metadata(int(probe_id))
-            except (ValueError, TypeError) as e:
-                if verbose:
-                    print(f"Warning: Invalid probe_id '{probe_id}': {e}", file=sys.stderr)
-                probe_metadata[probe_id] = DEFAULT_METADATA.copy()
-        else:
-            probe_metadata[probe_id] = DEFAULT_METADATA.copy()
+    probe_ids = df.loc[_missing_metadata(df), 'probe_id'] if only_missing else df['probe_id']
+    
+    # Get unique probe IDs as ints to avoid duplicate API calls, casting the column once
+    meta_df = _probe_metadata_frame(_unique_probe_ids(probe_ids), verbose=verbose, use_cache=use_cache)
     
     if verbose:
-        print("Adding metadata columns to dataframe...")
+        logger.info("Adding metadata columns to dataframe...")
     
-    # Add metadata columns to the dataframe using a single map operation
-    metadata_df = result_df['probe_id'].map(lambda x: probe_metadata.get(x, DEFAULT_METADATA)).apply(pd.Series)
-    for col in DEFAULT_METADATA.keys():
-        result_df[col] = metadata_df[col]
+    result_df = _merge_probe_metadata(df, meta_df, only_missing=only_missing)
     
     if verbose:
-        print(f"Successfully enriched {len(result_df)} rows")
+        logger.info(f"Successfully enriched {len(result_df)} rows")
     
     return result_df
 
 
-def add_probe_metadata(input_file, output_file=None):
+def _open_gzip_input(input_file):
+    """Open a gzip-compressed file for reading, decompressing on all cores if rapidgzip is installed."""
+    if rapidgzip is not None:
+        return rapidgzip.open(str(input_file), parallelization=os.cpu_count())
+    return gzip.open(input_file, 'rb')
+
+
+def _promote_dtype(a, b):
+    """
+    Return a dtype that holds the values of both dtypes, as inferred for a column read in one go.
+    
+    Args:
+        a: dtype inferred for a column in one chunk
+        b: dtype inferred for the same column in another chunk
+        
+    Returns:
+        The common dtype: the wider numeric type for two numeric dtypes, otherwise object
+    """
+    if a == b:
+        return a
+    if (pd.api.types.is_numeric_dtype(a) and pd.api.types.is_numeric_dtype(b)
+            and not pd.api.types.is_bool_dtype(a) and not pd.api.types.is_bool_dtype(b)):
+        return np.result_type(a, b)
+    return np.dtype(object)
+
+
+def _write_csv_gz(chunks, output_file):
+    """
+    Write DataFrame chunks to a single gzipped CSV file as they are produced.
+    
+    Each chunk is compressed and written before the next is enriched, and the
+    header is written with the first chunk only.
+    
+    Returns:
+        int: Number of rows written
+    """
+    rows = 0
+    # A single text stream over the compressor for all chunks, so pandas writes
+    # each chunk's CSV text straight into it without wrapping the file again
+    raw = gzip.GzipFile(output_file, 'wb', compresslevel=GZIP_COMPRESSLEVEL)
+    buffered = io.BufferedWriter(raw, buffer_size=WRITE_BUFFER_SIZE)
+    with io.TextIOWrapper(buffered, encoding='utf-8', newline='') as f:
+        for i, chunk in enumerate(chunks):
+            chunk.to_csv(f, index=False, header=(i == 0))
+            rows += len(chunk)
+    return rows
+
+
+def _arrow_text_type(arrow_type):
+    """Replace an Arrow null type, also as dictionary values, by string; other types are returned as is."""
+    import pyarrow as pa
+    
+    if pa.types.is_null(arrow_type):
+        return pa.string()
+    if pa.types.is_dictionary(arrow_type) and pa.types.is_null(arrow_type.value_type):
+        return pa.dictionary(arrow_type.index_type, pa.string(), arrow_type.ordered)
+    return arrow_type
+
+
+def _write_parquet(chunks, output_file):
+    """
+    Write DataFrame chunks to a single zstd-compressed Parquet file, with the schema of the first chunk.
+    
+    The chunks are expected to share their pandas dtypes.
+    
+    Returns:
+        int: Number of rows written
+        
+    Raises:
+        ImportError: If pyarrow is not installed
+        ValueError: If a chunk cannot be converted to the file's schema
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    
+    rows = 0
+    writer = None
+    try:
+        for chunk in chunks:
+            table = pa.Table.from_pandas(chunk, preserve_index=False)
+            if writer is None:
+                # A text column without values in the first chunk is inferred as null, or as
+                # a dictionary of nulls if categorical; store it as string so that later
+                # chunks with values fit the schema
+                schema = pa.schema(
+                    [field.with_type(_arrow_text_type(field.type)) for field in table.schema],
+                    metadata=table.schema.metadata,
+                )
+                writer = pq.ParquetWriter(output_file, schema, compression='zstd')
+            # Categorical columns may still differ in their dictionary index width
+            writer.write_table(table.cast(writer.schema))
+            rows += len(chunk)
+    except pa.ArrowException as e:
+        raise ValueError(e) from e
+    finally:
+        if writer is not None:
+            writer.close()
+    return rows
+
+
+# Metadata table of an enriching worker process, set once by _init_worker
+_worker_meta_df = None
+
+
+def _init_worker(meta_df):
+    """Keep the metadata table in the worker process, so that it is not sent along with every chunk."""
+    global _worker_meta_df
+    _worker_meta_df = meta_df
+
+
+def _enrich_csv_chunk(chunk, header, only_missing):
+    """Enrich a chunk in a worker process and return it as a compressed gzip member and its row count."""
+    text = _merge_probe_metadata(chunk, _worker_meta_df, only_missing).to_csv(index=False, header=header)
+    return gzip.compress(text.encode('utf-8'), compresslevel=GZIP_COMPRESSLEVEL), len(chunk)
+
+
+def _write_csv_gz_parallel(chunks, output_file, meta_df, workers, only_missing=False):
+    """
+    Enrich and compress chunks in worker processes and write them to a single gzipped CSV file.
+    
+    A gzip file may consist of several concatenated members, so each chunk is
+    compressed independently by a worker and this process appends the members
+    to the output in input order.
+    
+    Args:
+        chunks: Iterable of input DataFrame chunks
+        output_file: Path to the output file
+        meta_df: Metadata table as returned by _probe_metadata_frame
+        workers: Number of worker processes
+        only_missing: If True, rows that already have metadata keep it (default: False)
+        
+    Returns:
+        int: Number of rows written
+    """
+    rows = 0
+    pending = deque()
+    # Workers are started with spawn rather than fork: by then the input decoder
+    # (rapidgzip) is running threads in this process, and forking a multi-threaded
+    # process can deadlock the child
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context,
+                             initializer=_init_worker, initargs=(meta_df,)) as executor, \
+            open(output_file, 'wb') as f:
+        for i, chunk in enumerate(chunks):
+            pending.append(executor.submit(_enrich_csv_chunk, chunk, i == 0, only_missing))
+            # One chunk per worker plus one queued, so memory stays bounded by the chunk size
+            if len(pending) > workers:
+                data, count = pending.popleft().result()
+                f.write(data)
+                rows += count
+        for future in pending:
+            data, count = future.result()
+            f.write(data)
+            rows += count
+    return rows
+
+
+def add_probe_metadata(input_file, output_file=None, use_cache=True, output_format='csv.gz', workers=None,
+                       only_missing=False):
     """
     Add probe metadata to a CSV.GZ file.
     
     Args:
         input_file: Path to input .csv.gz file with 'probe_id' column
-        output_file: Path to output .csv.gz file (defaults to input_file with '_enriched' suffix)
+        output_file: Path to output file (defaults to input_file with '_enriched' suffix)
+        use_cache: If True, use the local probe metadata cache (default: True)
+        output_format: One of OUTPUT_FORMATS: 'csv.gz' or 'parquet' (default: 'csv.gz')
+        workers: Number of processes enriching and compressing gzipped CSV output
+            (default: DEFAULT_WORKERS, at most the number of CPUs; 1 disables the worker
+            processes). Memory use grows with the number of workers, by about one chunk each
+        only_missing: If True, only look up probes for rows without a 'country' value and
+            keep the existing metadata of all other rows (default: False)
+    
+    An input that already contains all metadata columns and a country for every
+    row with a probe ID is not enriched again; for csv.gz output it is copied unchanged.
     """
     # Determine output file path
     if output_file is None:
@@ -171,31 +815,79 @@ def add_probe_metadata(input_file, output_file=None):
             base = input_path.stem
             if base.endswith('.csv'):
                 base = base[:-4]
-            output_file = input_path.parent / f"{base}_enriched.csv.gz"
+            extension = '.csv.gz'
         else:
-            output_file = input_path.parent / f"{input_path.stem}_enriched{input_path.suffix}.gz"
-    
-    print(f"Reading input file: {input_file}")
+            base = input_path.stem
+            extension = f"{input_path.suffix}.gz"
+        if output_format == 'parquet':
+            extension = '.parquet'
+        output_file = input_path.parent / f"{base}_enriched{extension}"
     
-    # Read the input CSV.GZ file
+    # First pass: collect the probe IDs and the column types. Each chunk infers its
+    # own types, so they are promoted to what a single read of the whole file would
+    # infer, and the second pass reads every chunk with the same types
+    logger.info(f"Reading probe IDs from input file: {input_file}")
     try:
-        df = pd.read_csv(input_file, compression='gzip')
+        with _open_gzip_input(input_file) as f:
+            header = pd.read_csv(f, nrows=0).columns
+        if 'probe_id' not in header:
+            logger.error("Input file must contain a 'probe_id' column")
+            sys.exit(1)
+        metadata_cols = [col for col in DEFAULT_METADATA if col in header]
+        complete = len(metadata_cols) == len(DEFAULT_METADATA)
+        probe_ids = set()
+        dtypes = {}
+        with _open_gzip_input(input_file) as f:
+            for chunk in pd.read_csv(f, chunksize=CHUNK_SIZE):
+                for col, dtype in chunk.dtypes.items():
+                    dtypes[col] = _promote_dtype(dtypes[col], dtype) if col in dtypes else dtype
+                complete = complete and not _missing_metadata(chunk).any()
+                if only_missing:
+                    chunk = chunk[_missing_metadata(chunk)]
+                probe_ids.update(_unique_probe_ids(chunk['probe_id']))
     except Exception as e:
-        print(f"Error reading input file: {e}", file=sys.stderr)
+        logger.error(f"Could not read input file: {e}")
         sys.exit(1)
     
-    # Enrich the dataframe using the public function
-    try:
-        enriched_df = enrich_dataframe_with_probe_metadata(df, verbose=True)
-    except ValueError as e:
-        print(f"Error: {e}", file=sys.stderr)
-        sys.exit(1)
+    # Nothing needs to be looked up if every row already has metadata
+    if complete:
+        only_missing = True
+        probe_ids = set()
     
-    # Write the enriched dataframe to output file
-    print(f"Writing output file: {output_file}")
-    enriched_df.to_csv(output_file, compression='gzip', index=False)
+    if (only_missing and not probe_ids and len(metadata_cols) == len(DEFAULT_METADATA)
+            and output_format == 'csv.gz'):
+        logger.info("Input file already contains the probe metadata, copying it unchanged")
+        shutil.copyfile(input_file, output_file)
+        logger.info(f"Successfully saved enriched data to {output_file}")
+        return
     
-    print(f"Successfully saved enriched data to {output_file}")
+    meta_df = _probe_metadata_frame(probe_ids, verbose=True, use_cache=use_cache)
+    
+    # Second pass: enrich and write the rows chunk by chunk, so that the whole
+    # file is never held in memory
+    logger.info(f"Writing output file: {output_file}")
+    if workers is None:
+        workers = min(DEFAULT_WORKERS, os.cpu_count() or 1)
+    with _open_gzip_input(input_file) as f:
+        chunks = pd.read_csv(f, dtype=dtypes, chunksize=CHUNK_SIZE)
+        if output_format == 'parquet':
+            try:
+                rows = _write_parquet((_merge_probe_metadata(chunk, meta_df, only_missing) for chunk in chunks),
+                                      output_file)
+            except ImportError as e:
+                logger.error(f"Parquet output requires pyarrow (pip install pyarrow): {e}")
+                sys.exit(1)
+            except ValueError as e:
+                logger.error(f"Could not write Parquet output: {e}")
+                sys.exit(1)
+        elif workers > 1:
+            rows = _write_csv_gz_parallel(chunks, output_file, meta_df, workers, only_missing)
+        else:
+            rows = _write_csv_gz((_merge_probe_metadata(chunk, meta_df, only_missing) for chunk in chunks),
+                                 output_file)
+    
+    logger.info(f"Successfully enriched {rows:,} rows")
+    logger.info(f"Successfully saved enriched data to {output_file}")
 
 
 def main():
@@ -210,17 +902,49 @@ def main():
     parser.add_argument(
         '-o', '--output',
         dest='output_file',
-        help='Path to output .csv.gz file (default: input_file with _enriched suffix)'
+        help='Path to output file (default: input_file with _enriched suffix)'
+    )
+    parser.add_argument(
+        '--format',
+        dest='output_format',
+        choices=OUTPUT_FORMATS,
+        default='csv.gz',
+        help='Output file format (default: csv.gz)'
+    )
+    parser.add_argument(
+        '--workers',
+        type=int,
+        default=None,
+        help=f'Number of processes enriching and compressing csv.gz output; each holds a chunk of '
+             f'{CHUNK_SIZE:,} rows in memory (default: {DEFAULT_WORKERS}, at most the number of CPUs)'
+    )
+    parser.add_argument(
+        '--only-missing',
+        action='store_true',
+        help='Only look up probes for rows without metadata (no country) and keep existing metadata'
+    )
+    parser.add_argument(
+        '--no-cache',
+        dest='use_cache',
+        action='store_false',
+        help=f'Do not read or update the local probe metadata cache ({CACHE_PATH})'
     )
     
     args = parser.parse_args()
+    if args.workers is not None and args.workers < 1:
+        parser.error("--workers must be at least 1")
+    
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s: %(message)s')
+    # httpx logs every request at INFO level
+    logging.getLogger('httpx').setLevel(logging.WARNING)
     
     # Check if input file exists
     if not os.path.exists(args.input_file):
-        print(f"Error: Input file '{args.input_file}' not found", file=sys.stderr)
+        logger.error(f"Input file '{args.input_file}' not found")
         sys.exit(1)
     
-    add_probe_metadata(args.input_file, args.output_file)
+    add_probe_metadata(args.input_file, args.output_file, use_cache=args.use_cache,
+                       output_format=args.output_format, workers=args.workers, only_missing=args.only_missing)
 
 
 if __name__ == '__main__':